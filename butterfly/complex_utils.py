@@ -170,6 +170,18 @@ def complex_matmul_torch(X, Y):
     return complex_mul_torch(X.unsqueeze(-2), Y.unsqueeze(-4)).sum(dim=-3)
 
 
+def complex_matmul_native(X, Y):
+    """Multiply two complex matrices stored in our format, using Pytorch's
+    native complex dtype (Pytorch >= 1.8).
+    Parameters:
+       X: (..., n, m, 2)
+       Y: (..., m, p, 2)
+    Return:
+       Z: (..., n, p, 2)
+    """
+    return torch.view_as_real(torch.view_as_complex(X.contiguous()) @ torch.view_as_complex(Y.contiguous()))
+
+
 class ComplexMatmulNp(torch.autograd.Function):
     """Multiply two complex matrices, in numpy.
     Parameters:
@@ -227,6 +239,23 @@ def test_complex_mm():
     assert torch.allclose(dY, dY_torch)
 
 
+def test_complex_native():
+    n = 5
+    m = 7
+    p = 4
+    X = torch.rand(n, m, 2, requires_grad=True)
+    Y = torch.rand(m, p, 2, requires_grad=True)
+    Z = complex_matmul_native(X, Y)
+    Z_torch = complex_matmul_torch(X, Y)
+    assert torch.allclose(Z, Z_torch, atol=1e-6)
+    g = torch.rand_like(Z)
+    dX, dY = torch.autograd.grad(Z, (X, Y), g)
+    dX_torch, dY_torch = torch.autograd.grad(Z_torch, (X, Y), g)
+    assert torch.allclose(dX, dX_torch, atol=1e-6)
+    assert torch.allclose(dY, dY_torch, atol=1e-6)
+
+
 if __name__ == '__main__':
     test_complex_mul()
     test_complex_mm()
+    test_complex_native()
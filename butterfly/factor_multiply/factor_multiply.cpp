@@ -1684,6 +1684,270 @@ std::vector<at::Tensor> permutation_factor_reverse_multiply_backward(const at::T
   return {d_p, d_input};
 }
 
+static void check_dia_diagonals(const char* name, const at::Tensor& diag, const at::Tensor& subdiag,
+                                const at::Tensor& superdiag, const at::Tensor& input, int64_t diagonal) {
+  /* Check that diag: (n, ), subdiag and superdiag: (n - diagonal, ) match input: (batch_size, n, ...). */
+  TORCH_CHECK(!input.is_cuda() && !diag.is_cuda() && !subdiag.is_cuda() && !superdiag.is_cuda(),
+              name, ": Expected all tensors to be CPU tensors");
+  TORCH_CHECK(input.dim() >= 2, name, ": input must have shape (batch_size, n) or (batch_size, n, 2)");
+  const auto n = input.size(1);
+  const auto k = diagonal;
+  TORCH_CHECK(0 < k && k < n, name, ": diagonal must be between 1 and n - 1");
+  TORCH_CHECK(diag.dim() == 1 && diag.size(0) == n, name, ": diagonals must have shape (n, )");
+  TORCH_CHECK(subdiag.dim() == 1 && subdiag.size(0) == n - k, name, ": subdiagonals must have shape (n - diagonal, )");
+  TORCH_CHECK(superdiag.dim() == 1 && superdiag.size(0) == n - k, name, ": superdiagonals must have shape (n - diagonal, )");
+  TORCH_CHECK(diag.scalar_type() == input.scalar_type() && subdiag.scalar_type() == input.scalar_type()
+              && superdiag.scalar_type() == input.scalar_type(),
+              name, ": Expected all tensors to have the same dtype");
+}
+
+at::Tensor butterfly_dia_multiply(const at::Tensor& diag, const at::Tensor& subdiag, const at::Tensor& superdiag,
+                                  const at::Tensor& input, int64_t diagonal) {
+  /* Multiply by a banded matrix whose only nonzeros are the main diagonal and
+     the @diagonal-th subdiagonal and superdiagonal (DIA format), in one pass over the input.
+     Parameters:
+         diag: (n, )
+         subdiag: (n - diagonal, )
+         superdiag: (n - diagonal, )
+         input: (batch_size, n)
+     Return:
+         output: (batch_size, n)
+  */
+  TORCH_CHECK(input.dim() == 2, "butterfly_dia_multiply: input must have shape (batch_size, n)");
+  check_dia_diagonals("butterfly_dia_multiply", diag, subdiag, superdiag, input, diagonal);
+  const auto batch_size = input.size(0);
+  const auto n = input.size(1);
+  const auto k = diagonal;
+  const auto input_c = input.contiguous();
+  const auto diag_c = diag.contiguous();
+  const auto subdiag_c = subdiag.contiguous();
+  const auto superdiag_c = superdiag.contiguous();
+  auto output = torch::empty_like(input_c);
+  // _Pragma instead of #pragma since we're inside the AT_DISPATCH macro
+  AT_DISPATCH_FLOATING_TYPES(input.scalar_type(), "butterfly_dia_multiply", [&] {
+    const scalar_t* d = diag_c.data_ptr<scalar_t>();
+    const scalar_t* sub = subdiag_c.data_ptr<scalar_t>();
+    const scalar_t* sup = superdiag_c.data_ptr<scalar_t>();
+    for (int64_t b = 0; b < batch_size; ++b) {
+      const scalar_t* x = input_c.data_ptr<scalar_t>() + b * n;
+      scalar_t* out = output.data_ptr<scalar_t>() + b * n;
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n; ++i) {
+        out[i] = d[i] * x[i];
+      }
+      // Two separate sweeps so that neither loop carries a dependency through out[]
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n - k; ++i) {
+        out[i] += sup[i] * x[i + k];
+      }
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n - k; ++i) {
+        out[i + k] += sub[i] * x[i];
+      }
+    }
+  });
+  return output;
+}
+
+std::vector<at::Tensor> butterfly_dia_multiply_backward(const at::Tensor& grad, const at::Tensor& diag, const at::Tensor& subdiag,
+                                                        const at::Tensor& superdiag, const at::Tensor& input, int64_t diagonal) {
+  /* Parameters:
+         grad: (batch_size, n)
+         diag: (n, )
+         subdiag: (n - diagonal, )
+         superdiag: (n - diagonal, )
+         input: (batch_size, n)
+     Return:
+         d_diag: (n, )
+         d_subdiag: (n - diagonal, )
+         d_superdiag: (n - diagonal, )
+         d_input: (batch_size, n)
+  */
+  TORCH_CHECK(input.dim() == 2, "butterfly_dia_multiply_backward: input must have shape (batch_size, n)");
+  check_dia_diagonals("butterfly_dia_multiply_backward", diag, subdiag, superdiag, input, diagonal);
+  TORCH_CHECK(!grad.is_cuda() && grad.sizes() == input.sizes() && grad.scalar_type() == input.scalar_type(),
+              "butterfly_dia_multiply_backward: grad must be a CPU tensor with the same shape and dtype as input");
+  const auto batch_size = input.size(0);
+  const auto n = input.size(1);
+  const auto k = diagonal;
+  const auto grad_c = grad.contiguous();
+  const auto input_c = input.contiguous();
+  const auto diag_c = diag.contiguous();
+  const auto subdiag_c = subdiag.contiguous();
+  const auto superdiag_c = superdiag.contiguous();
+  auto d_diag = torch::zeros_like(diag_c);
+  auto d_subdiag = torch::zeros_like(subdiag_c);
+  auto d_superdiag = torch::zeros_like(superdiag_c);
+  auto d_input = torch::empty_like(input_c);
+  AT_DISPATCH_FLOATING_TYPES(input.scalar_type(), "butterfly_dia_multiply_backward", [&] {
+    const scalar_t* d = diag_c.data_ptr<scalar_t>();
+    const scalar_t* sub = subdiag_c.data_ptr<scalar_t>();
+    const scalar_t* sup = superdiag_c.data_ptr<scalar_t>();
+    scalar_t* d_d = d_diag.data_ptr<scalar_t>();
+    scalar_t* d_sub = d_subdiag.data_ptr<scalar_t>();
+    scalar_t* d_sup = d_superdiag.data_ptr<scalar_t>();
+    for (int64_t b = 0; b < batch_size; ++b) {
+      const scalar_t* x = input_c.data_ptr<scalar_t>() + b * n;
+      const scalar_t* g = grad_c.data_ptr<scalar_t>() + b * n;
+      scalar_t* d_x = d_input.data_ptr<scalar_t>() + b * n;
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n; ++i) {
+        d_d[i] += g[i] * x[i];
+        d_x[i] = d[i] * g[i];
+      }
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n - k; ++i) {
+        d_sub[i] += g[i + k] * x[i];
+        d_sup[i] += g[i] * x[i + k];
+        d_x[i] += sub[i] * g[i + k];
+      }
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n - k; ++i) {
+        d_x[i + k] += sup[i] * g[i];
+      }
+    }
+  });
+  return {d_diag, d_subdiag, d_superdiag, d_input};
+}
+
+at::Tensor butterfly_dia_multiply_complex(const at::Tensor& diag_re, const at::Tensor& diag_im,
+                                          const at::Tensor& subdiag_re, const at::Tensor& subdiag_im,
+                                          const at::Tensor& superdiag_re, const at::Tensor& superdiag_im,
+                                          const at::Tensor& input, int64_t diagonal) {
+  /* Complex version of butterfly_dia_multiply. The diagonals are given as separate
+     real and imaginary parts, so that they are read with unit stride.
+     Parameters:
+         diag_re, diag_im: (n, )
+         subdiag_re, subdiag_im: (n - diagonal, )
+         superdiag_re, superdiag_im: (n - diagonal, )
+         input: (batch_size, n, 2), real and imaginary parts interleaved
+     Return:
+         output: (batch_size, n, 2)
+  */
+  TORCH_CHECK(input.dim() == 3 && input.size(2) == 2, "butterfly_dia_multiply_complex: input must have shape (batch_size, n, 2)");
+  check_dia_diagonals("butterfly_dia_multiply_complex", diag_re, subdiag_re, superdiag_re, input, diagonal);
+  check_dia_diagonals("butterfly_dia_multiply_complex", diag_im, subdiag_im, superdiag_im, input, diagonal);
+  const auto batch_size = input.size(0);
+  const auto n = input.size(1);
+  const auto k = diagonal;
+  const auto input_c = input.contiguous();
+  const auto diag_re_c = diag_re.contiguous(), diag_im_c = diag_im.contiguous();
+  const auto subdiag_re_c = subdiag_re.contiguous(), subdiag_im_c = subdiag_im.contiguous();
+  const auto superdiag_re_c = superdiag_re.contiguous(), superdiag_im_c = superdiag_im.contiguous();
+  auto output = torch::empty_like(input_c);
+  AT_DISPATCH_FLOATING_TYPES(input.scalar_type(), "butterfly_dia_multiply_complex", [&] {
+    const scalar_t* dr = diag_re_c.data_ptr<scalar_t>();
+    const scalar_t* di = diag_im_c.data_ptr<scalar_t>();
+    const scalar_t* subr = subdiag_re_c.data_ptr<scalar_t>();
+    const scalar_t* subi = subdiag_im_c.data_ptr<scalar_t>();
+    const scalar_t* supr = superdiag_re_c.data_ptr<scalar_t>();
+    const scalar_t* supi = superdiag_im_c.data_ptr<scalar_t>();
+    for (int64_t b = 0; b < batch_size; ++b) {
+      const scalar_t* x = input_c.data_ptr<scalar_t>() + b * n * 2;
+      scalar_t* out = output.data_ptr<scalar_t>() + b * n * 2;
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n; ++i) {
+        out[2 * i] = dr[i] * x[2 * i] - di[i] * x[2 * i + 1];
+        out[2 * i + 1] = dr[i] * x[2 * i + 1] + di[i] * x[2 * i];
+      }
+      const scalar_t* xk = x + 2 * k;
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n - k; ++i) {
+        out[2 * i] += supr[i] * xk[2 * i] - supi[i] * xk[2 * i + 1];
+        out[2 * i + 1] += supr[i] * xk[2 * i + 1] + supi[i] * xk[2 * i];
+      }
+      scalar_t* outk = out + 2 * k;
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n - k; ++i) {
+        outk[2 * i] += subr[i] * x[2 * i] - subi[i] * x[2 * i + 1];
+        outk[2 * i + 1] += subr[i] * x[2 * i + 1] + subi[i] * x[2 * i];
+      }
+    }
+  });
+  return output;
+}
+
+std::vector<at::Tensor> butterfly_dia_multiply_complex_backward(const at::Tensor& grad,
+                                                                const at::Tensor& diag_re, const at::Tensor& diag_im,
+                                                                const at::Tensor& subdiag_re, const at::Tensor& subdiag_im,
+                                                                const at::Tensor& superdiag_re, const at::Tensor& superdiag_im,
+                                                                const at::Tensor& input, int64_t diagonal) {
+  /* Parameters:
+         grad: (batch_size, n, 2)
+         diag_re, diag_im: (n, )
+         subdiag_re, subdiag_im: (n - diagonal, )
+         superdiag_re, superdiag_im: (n - diagonal, )
+         input: (batch_size, n, 2)
+     Return:
+         d_diag_re, d_diag_im: (n, )
+         d_subdiag_re, d_subdiag_im: (n - diagonal, )
+         d_superdiag_re, d_superdiag_im: (n - diagonal, )
+         d_input: (batch_size, n, 2)
+  */
+  TORCH_CHECK(input.dim() == 3 && input.size(2) == 2, "butterfly_dia_multiply_complex_backward: input must have shape (batch_size, n, 2)");
+  check_dia_diagonals("butterfly_dia_multiply_complex_backward", diag_re, subdiag_re, superdiag_re, input, diagonal);
+  check_dia_diagonals("butterfly_dia_multiply_complex_backward", diag_im, subdiag_im, superdiag_im, input, diagonal);
+  TORCH_CHECK(!grad.is_cuda() && grad.sizes() == input.sizes() && grad.scalar_type() == input.scalar_type(),
+              "butterfly_dia_multiply_complex_backward: grad must be a CPU tensor with the same shape and dtype as input");
+  const auto batch_size = input.size(0);
+  const auto n = input.size(1);
+  const auto k = diagonal;
+  const auto grad_c = grad.contiguous();
+  const auto input_c = input.contiguous();
+  const auto diag_re_c = diag_re.contiguous(), diag_im_c = diag_im.contiguous();
+  const auto subdiag_re_c = subdiag_re.contiguous(), subdiag_im_c = subdiag_im.contiguous();
+  const auto superdiag_re_c = superdiag_re.contiguous(), superdiag_im_c = superdiag_im.contiguous();
+  auto d_diag_re = torch::zeros_like(diag_re_c), d_diag_im = torch::zeros_like(diag_im_c);
+  auto d_subdiag_re = torch::zeros_like(subdiag_re_c), d_subdiag_im = torch::zeros_like(subdiag_im_c);
+  auto d_superdiag_re = torch::zeros_like(superdiag_re_c), d_superdiag_im = torch::zeros_like(superdiag_im_c);
+  auto d_input = torch::empty_like(input_c);
+  AT_DISPATCH_FLOATING_TYPES(input.scalar_type(), "butterfly_dia_multiply_complex_backward", [&] {
+    const scalar_t* dr = diag_re_c.data_ptr<scalar_t>();
+    const scalar_t* di = diag_im_c.data_ptr<scalar_t>();
+    const scalar_t* subr = subdiag_re_c.data_ptr<scalar_t>();
+    const scalar_t* subi = subdiag_im_c.data_ptr<scalar_t>();
+    const scalar_t* supr = superdiag_re_c.data_ptr<scalar_t>();
+    const scalar_t* supi = superdiag_im_c.data_ptr<scalar_t>();
+    scalar_t* d_dr = d_diag_re.data_ptr<scalar_t>();
+    scalar_t* d_di = d_diag_im.data_ptr<scalar_t>();
+    scalar_t* d_subr = d_subdiag_re.data_ptr<scalar_t>();
+    scalar_t* d_subi = d_subdiag_im.data_ptr<scalar_t>();
+    scalar_t* d_supr = d_superdiag_re.data_ptr<scalar_t>();
+    scalar_t* d_supi = d_superdiag_im.data_ptr<scalar_t>();
+    // Gradients are multiplied by the complex conjugate
+    for (int64_t b = 0; b < batch_size; ++b) {
+      const scalar_t* x = input_c.data_ptr<scalar_t>() + b * n * 2;
+      const scalar_t* g = grad_c.data_ptr<scalar_t>() + b * n * 2;
+      scalar_t* d_x = d_input.data_ptr<scalar_t>() + b * n * 2;
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n; ++i) {
+        d_dr[i] += g[2 * i] * x[2 * i] + g[2 * i + 1] * x[2 * i + 1];
+        d_di[i] += g[2 * i + 1] * x[2 * i] - g[2 * i] * x[2 * i + 1];
+        d_x[2 * i] = dr[i] * g[2 * i] + di[i] * g[2 * i + 1];
+        d_x[2 * i + 1] = dr[i] * g[2 * i + 1] - di[i] * g[2 * i];
+      }
+      const scalar_t* xk = x + 2 * k;
+      const scalar_t* gk = g + 2 * k;
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n - k; ++i) {
+        d_subr[i] += gk[2 * i] * x[2 * i] + gk[2 * i + 1] * x[2 * i + 1];
+        d_subi[i] += gk[2 * i + 1] * x[2 * i] - gk[2 * i] * x[2 * i + 1];
+        d_supr[i] += g[2 * i] * xk[2 * i] + g[2 * i + 1] * xk[2 * i + 1];
+        d_supi[i] += g[2 * i + 1] * xk[2 * i] - g[2 * i] * xk[2 * i + 1];
+        d_x[2 * i] += subr[i] * gk[2 * i] + subi[i] * gk[2 * i + 1];
+        d_x[2 * i + 1] += subr[i] * gk[2 * i + 1] - subi[i] * gk[2 * i];
+      }
+      scalar_t* d_xk = d_x + 2 * k;
+      _Pragma("omp simd")
+      for (int64_t i = 0; i < n - k; ++i) {
+        d_xk[2 * i] += supr[i] * g[2 * i] + supi[i] * g[2 * i + 1];
+        d_xk[2 * i + 1] += supr[i] * g[2 * i + 1] - supi[i] * g[2 * i];
+      }
+    }
+  });
+  return {d_diag_re, d_diag_im, d_subdiag_re, d_subdiag_im, d_superdiag_re, d_superdiag_im, d_input};
+}
+
 // at::Tensor flip(const at::Tensor& input) {
 //   auto output = torch::empty_like(input);
 //   auto input_neg_strides = torch::from_blob(input.data<float>() + input.size(0) - 1, input.sizes(), {-1});
@@ -1762,5 +2026,9 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("permutation_factor_even_odd_multiply_backward", &permutation_factor_even_odd_multiply_backward, "Permutation factor (even odd) multiply backward");
   m.def("permutation_factor_reverse_multiply", &permutation_factor_reverse_multiply, "Permutation factor (reverse) multiply forward");
   m.def("permutation_factor_reverse_multiply_backward", &permutation_factor_reverse_multiply_backward, "Permutation factor (even odd) multiply backward");
+  m.def("butterfly_dia_multiply", &butterfly_dia_multiply, "Butterfly DIA (3 diagonals) multiply forward");
+  m.def("butterfly_dia_multiply_backward", &butterfly_dia_multiply_backward, "Butterfly DIA (3 diagonals) multiply backward");
+  m.def("butterfly_dia_multiply_complex", &butterfly_dia_multiply_complex, "Butterfly DIA (3 diagonals) complex multiply forward");
+  m.def("butterfly_dia_multiply_complex_backward", &butterfly_dia_multiply_complex_backward, "Butterfly DIA (3 diagonals) complex multiply backward");
   m.def("complex_test", &complex_test, "complex_test");
 }
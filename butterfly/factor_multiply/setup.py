@@ -1,8 +1,19 @@
+import os
 from setuptools import setup
 import torch.cuda
 from torch.utils.cpp_extension import CppExtension, CUDAExtension, BuildExtension
 from torch.utils.cpp_extension import CUDA_HOME
 
+# OpenMP is needed for the "omp simd" loops to be vectorized.
+# -ffast-math is left out on purpose since some callers rely on inf/nan semantics.
+# -march=native already enables AVX2/FMA on hosts that have them, the options
+# below are for building on a different machine than the one running the code.
+cxx_flags = ['-g', '-O3', '-march=native', '-fopenmp', '-funroll-loops']
+if os.getenv('USE_AVX2', '0') == '1':  # Haswell and later
+    cxx_flags += ['-mavx2', '-mfma']
+if os.getenv('USE_AVX512', '0') == '1':  # Skylake-X and later
+    cxx_flags += ['-mavx512f', '-mavx512vl']
+
 ext_modules = []
 if torch.cuda.is_available() and CUDA_HOME is not None:
     extension = CUDAExtension(
@@ -10,12 +21,13 @@ if torch.cuda.is_available() and CUDA_HOME is not None:
             'factor_multiply.cpp',
             'factor_multiply_cuda.cu',
         ],
-        extra_compile_args={'cxx': ['-g', '-march=native', '-funroll-loops'],
+        extra_compile_args={'cxx': cxx_flags,
                             # 'nvcc': ['-arch=sm_60', '-O2', '-lineinfo']})
                             'nvcc': ['-O2', '--expt-extended-lambda', '-lineinfo']
-                                    + (['-arch=sm_70'] if torch.cuda.get_device_capability() == (7, 0) else [])})
+                                    + (['-arch=sm_70'] if torch.cuda.get_device_capability() == (7, 0) else [])},
+        extra_link_args=['-fopenmp'])
     ext_modules.append(extension)
-# extension = CppExtension('factor_multiply', ['factor_multiply.cpp'], extra_compile_args=['-march=native'])
+# extension = CppExtension('factor_multiply', ['factor_multiply.cpp'], extra_compile_args={'cxx': cxx_flags}, extra_link_args=['-fopenmp'])
 # extension = CppExtension('factor_multiply', ['factor_multiply.cpp'])
 # ext_modules.append(extension)
 
@@ -100,6 +100,30 @@ class ButterflyConv2d(ButterflyBmm):
             output = output + self.bias_conv
         return output.view(batch, h_out * w_out, self.out_channels).transpose(1, 2).view(batch, self.out_channels, h_out, w_out)
 
+    def dense_weight(self):
+        """Materialize the weight of the convolution as a dense tensor, e.g. to
+        run inference with F.conv2d. The product of the butterfly factors is
+        generally dense, so this doesn't lose any sparsity.
+        Return:
+            weight: (out_channels, in_channels, kernel_size[0], kernel_size[1]), detached from the parameters
+        """
+        k = self.kernel_size[0] * self.kernel_size[1]
+        with torch.no_grad():
+            eye = torch.eye(self.in_channels, dtype=self.twiddle.dtype, device=self.twiddle.device)
+            # The output is the mean over the kernel positions of the butterfly products
+            weight = super().forward(eye.unsqueeze(1).expand(-1, k, -1)) / k
+        return weight.permute(2, 0, 1).reshape(self.out_channels, self.in_channels, *self.kernel_size)
+
+    def forward_dense(self, input, weight):
+        """Convolution with the weight returned by dense_weight.
+        Parameters:
+            input: (batch, c, h, w)
+            weight: (out_channels, c, kernel_size[0], kernel_size[1])
+        Return:
+            output: (batch, out_channels, h_out, w_out)
+        """
+        return F.conv2d(input, weight, getattr(self, 'bias_conv', None), self.stride, self.padding, self.dilation)
+
 
 class ButterflyConv2dBBT(nn.Module):
     """Product of log N butterfly factors, each is a block 2x2 of diagonal matrices.
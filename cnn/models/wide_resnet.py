@@ -2,9 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.init as init
 import torch.nn.functional as F
-from torch.autograd import Variable
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
-import sys
 import numpy as np
 
 from cnn.models.butterfly_conv import ButterflyConv2d
@@ -16,15 +15,21 @@ def conv3x3(in_planes, out_planes, stride=1):
 def conv_init(m):
     classname = m.__class__.__name__
     if classname.find('Conv') != -1:
-        init.xavier_uniform(m.weight, gain=np.sqrt(2))
-        init.constant(m.bias, 0)
+        init.xavier_uniform_(m.weight, gain=np.sqrt(2))
+        init.constant_(m.bias, 0)
     elif classname.find('BatchNorm') != -1:
-        init.constant(m.weight, 1)
-        init.constant(m.bias, 0)
+        init.constant_(m.weight, 1)
+        init.constant_(m.bias, 0)
 
 class wide_basic(nn.Module):
-    def __init__(self, in_planes, planes, dropout_rate, stride=1, structure_type=None, **kwargs):
+    def __init__(self, in_planes, planes, dropout_rate, stride=1, structure_type=None,
+                 dense_shortcut=False, **kwargs):
         super(wide_basic, self).__init__()
+        # In eval mode, run a butterfly 1x1 shortcut as a plain convolution with
+        # the cached dense weight
+        self.dense_shortcut = dense_shortcut and structure_type == 'B'
+        self._shortcut_weight = None
+        self._shortcut_weight_key = None
         self.bn1 = nn.BatchNorm2d(in_planes)
         if structure_type == 'B':
             self.conv1 = ButterflyConv2d(in_planes, planes, kernel_size=3, stride=stride,
@@ -60,13 +65,38 @@ class wide_basic(nn.Module):
                 conv
             )
 
+    def shortcut_weight_key(self):
+        """Key identifying the weight of the shortcut. It changes whenever a
+        parameter is modified in place (version counter) or moved (data_ptr).
+        """
+        return tuple((p.data_ptr(), p._version) for p in self.shortcut.parameters())
+
+    def shortcut_forward(self, x):
+        if self.training or not self.dense_shortcut or len(self.shortcut) == 0:
+            return self.shortcut(x)
+        conv = self.shortcut[0]
+        key = self.shortcut_weight_key()
+        if key != self._shortcut_weight_key:
+            self._shortcut_weight, self._shortcut_weight_key = conv.dense_weight(), key
+        return conv.forward_dense(x, self._shortcut_weight)
+
     def forward(self, x):
         out = self.dropout(self.conv1(F.relu(self.bn1(x))))
         out = self.conv2(F.relu(self.bn2(out)))
-        out += self.shortcut(x)
+        out += self.shortcut_forward(x)
 
         return out
 
+    def fuse_conv_bn(self):
+        """Fold bn2 into conv1, for inference only. In eval mode dropout is the
+        identity, so bn2 directly follows conv1. Only plain convolutions are folded.
+        """
+        assert not self.training, 'fuse_conv_bn only works in eval mode'
+        if isinstance(self.conv1, nn.Conv2d) and isinstance(self.bn2, nn.BatchNorm2d):
+            self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn2)
+            self.bn2 = nn.Identity()
+        return self
+
 class Wide_ResNet(nn.Module):
     def __init__(self, depth, widen_factor, dropout_rate, num_classes, structure_type=None, **kwargs):
         super(Wide_ResNet, self).__init__()
@@ -108,11 +138,59 @@ class Wide_ResNet(nn.Module):
 
         return out
 
+    def fuse_conv_bn(self):
+        """Fold the BatchNorm layers that directly follow a convolution into it, for inference only.
+        """
+        for module in self.modules():
+            if isinstance(module, wide_basic):
+                module.fuse_conv_bn()
+        return self
+
+def test_wide_basic_dense_shortcut():
+    block = wide_basic(32, 64, 0.0, stride=2, structure_type='B', dense_shortcut=True, fast=False)
+    block.eval()
+    conv = block.shortcut[0]
+    assert hasattr(conv, 'bias_conv')
+    x = torch.randn(2, 32, 8, 8)
+    with torch.no_grad():
+        assert torch.allclose(block.conv1.forward_dense(x, block.conv1.dense_weight()), block.conv1(x), atol=1e-5)
+        assert torch.allclose(block.shortcut_forward(x), block.shortcut(x), atol=1e-5)
+        # The cached dense weight must follow in-place updates, e.g. load_state_dict
+        state_dict = {name: 2 * value for name, value in block.state_dict().items()}
+        block.load_state_dict(state_dict)
+        assert torch.allclose(block.shortcut_forward(x), block.shortcut(x), atol=1e-5)
+
+def test_fuse_conv_bn():
+    net = Wide_ResNet(10, 2, 0.3, 10)
+    with torch.no_grad():
+        net(torch.randn(8, 3, 32, 32))  # Non-trivial running statistics
+    net.eval()
+    x = torch.randn(2, 3, 32, 32)
+    with torch.no_grad():
+        y = net(x)
+        assert torch.allclose(net.fuse_conv_bn()(x), y, atol=1e-5)
+
 if __name__ == '__main__':
+    test_wide_basic_dense_shortcut()
+    test_fuse_conv_bn()
     net=Wide_ResNet(28, 8, 0.0, 10)
-    y = net(Variable(torch.randn(1,3,32,32)))
+    y = net(torch.randn(1,3,32,32))
 
     print(y.size())
 
 def WideResNet28(structure_type=None, **kwargs):
     return Wide_ResNet(28, 2, 0.0, 10, structure_type=structure_type, **kwargs)
+
+def compiled_wide_resnet(*args, state_dict=None, **kwargs):
+    """Wide_ResNet wrapped with torch.compile, so that the BN -> ReLU -> conv chains are fused.
+    If state_dict is given, the model is loaded from it and prepared for inference:
+    eval mode, with the conv -> BN pairs folded (see Wide_ResNet.fuse_conv_bn).
+    Falls back to the plain model on PyTorch versions without torch.compile.
+    """
+    model = Wide_ResNet(*args, **kwargs)
+    if state_dict is not None:
+        model.load_state_dict(state_dict)
+        model.eval().fuse_conv_bn()
+    if not hasattr(torch, 'compile'):
+        return model
+    return torch.compile(model, mode='reduce-overhead')
@@ -7,6 +7,8 @@ from butterfly.complex_utils import real_to_complex, complex_mul, complex_matmul
 
 from factor_multiply import butterfly_factor_multiply, butterfly_factor_multiply_backward
 from factor_multiply import butterfly_multiply_intermediate, butterfly_multiply_intermediate_backward
+from factor_multiply import butterfly_dia_multiply, butterfly_dia_multiply_backward
+from factor_multiply import butterfly_dia_multiply_complex, butterfly_dia_multiply_complex_backward
 # from ABCD_mult import ABCD_mult
 
 
@@ -54,6 +56,40 @@ class ButterflyFactorMultIntermediate(torch.autograd.Function):
 butterfly_factor_mult_intermediate = ButterflyFactorMultIntermediate.apply
 
 
+class ButterflyDiaMult(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, diag, subdiag, superdiag, input, diagonal):
+        ctx.save_for_backward(diag, subdiag, superdiag, input)
+        ctx.diagonal = diagonal
+        return butterfly_dia_multiply(diag, subdiag, superdiag, input, diagonal)
+
+    @staticmethod
+    def backward(ctx, grad):
+        diag, subdiag, superdiag, input = ctx.saved_tensors
+        d_diag, d_subdiag, d_superdiag, d_input = butterfly_dia_multiply_backward(grad, diag, subdiag, superdiag, input, ctx.diagonal)
+        return d_diag, d_subdiag, d_superdiag, d_input, None
+
+butterfly_dia_mult = ButterflyDiaMult.apply
+
+
+class ButterflyDiaMultComplex(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, diag_re, diag_im, subdiag_re, subdiag_im, superdiag_re, superdiag_im, input, diagonal):
+        ctx.save_for_backward(diag_re, diag_im, subdiag_re, subdiag_im, superdiag_re, superdiag_im, input)
+        ctx.diagonal = diagonal
+        return butterfly_dia_multiply_complex(diag_re, diag_im, subdiag_re, subdiag_im, superdiag_re, superdiag_im,
+                                              input, diagonal)
+
+    @staticmethod
+    def backward(ctx, grad):
+        *diagonals, input = ctx.saved_tensors
+        return (*butterfly_dia_multiply_complex_backward(grad, *diagonals, input, ctx.diagonal), None)
+
+butterfly_dia_mult_complex = ButterflyDiaMultComplex.apply
+
+
 def test_butterfly_factor_multiply():
     import time
     n = 1024
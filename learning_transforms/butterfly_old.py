@@ -4,28 +4,103 @@ import functools
 
 import torch
 from torch import nn
+import torch.nn.functional as F
 
-from butterfly.complex_utils import real_to_complex, complex_mul, complex_matmul
+from butterfly.complex_utils import real_to_complex, complex_mul, complex_matmul, complex_matmul_native
 from sparsemax import sparsemax
 from butterfly.utils import bitreversal_permutation
-from butterfly_factor import butterfly_factor_mult, butterfly_factor_mult_intermediate
+from butterfly_factor import butterfly_factor_mult, butterfly_factor_mult_intermediate, butterfly_dia_mult, butterfly_dia_mult_complex
 from permutation_factor import permutation_factor_even_odd_mult, permutation_factor_reverse_mult
 
+# Tolerance for stopping Sinkhorn iterations early in eval mode
+SINKHORN_EVAL_TOL = 1e-4
+# Largest input (batch size times size) for which ButterflyProduct applies each
+# learned-order term with butterfly_mixture_mult. Beyond that (and for complex
+# inputs) multiplying by the factors one by one is faster.
+MIXTURE_MAX_NUMEL = 2048
 
-def sinkhorn(logit, n_iters=5):
+
+def sinkhorn(logit, n_iters=5, tol=None):
     """Sinkhorn iterations.
     Parameters:
         logit: (..., n, n)
         n_iters: integer
+        tol: if not None, stop early once the row sums are within tol of 1 (in
+            log space) after the columns are normalized. This needs a GPU sync
+            per iteration, so it's meant for evaluation rather than training.
     Return:
         (..., n, n) matrix that's close to a doubly stochastic matrix.
     """
     assert logit.dim() >= 2, 'logit must be at least a 2D tensor'
     assert logit.shape[-2] == logit.shape[-1], 'logit must be a square matrix'
-    for _ in range(n_iters):
-        logit = logit - torch.logsumexp(logit, dim=-1, keepdim=True)
-        logit = logit - torch.logsumexp(logit, dim=-2, keepdim=True)
-    return torch.exp(logit)
+    for i in range(n_iters):
+        if tol is None:
+            logit = F.log_softmax(logit, dim=-1)
+        else:  # Same as log_softmax, but the row normalizers are also the convergence check
+            row_lse = torch.logsumexp(logit, dim=-1, keepdim=True)
+            if i > 0 and row_lse.abs().max().item() < tol:
+                break
+            logit = logit - row_lse
+        logit = F.log_softmax(logit, dim=-2)
+    # log_softmax saves its output for backward, so only exponentiate in place
+    # when no graph is being built (and logit is no longer the caller's tensor).
+    if n_iters == 0 or logit.requires_grad:
+        return torch.exp(logit)
+    return logit.exp_()
+
+
+# Source of the TorchScript forward functions of Butterfly, with the diagonal
+# offset {k} substituted as a literal. The functions are written out-of-place so
+# that TorchScript can fuse the pointwise ops.
+_FWD_REAL_SOURCE = """
+def forward(diag, subdiag, superdiag, input):
+    output = diag * input
+    output[..., {k}:] = output[..., {k}:] + subdiag * input[..., :-{k}]
+    output[..., :-{k}] = output[..., :-{k}] + superdiag * input[..., {k}:]
+    return output
+"""
+
+_FWD_COMPLEX_SOURCE = """
+def forward(diag_re, diag_im, subdiag_re, subdiag_im, superdiag_re, superdiag_im, input):
+    input_re, input_im = input[..., 0], input[..., 1]
+    output_re = diag_re * input_re - diag_im * input_im
+    output_im = diag_re * input_im + diag_im * input_re
+    output_re[..., {k}:] = (output_re[..., {k}:] + subdiag_re * input_re[..., :-{k}]
+                            - subdiag_im * input_im[..., :-{k}])
+    output_im[..., {k}:] = (output_im[..., {k}:] + subdiag_re * input_im[..., :-{k}]
+                            + subdiag_im * input_re[..., :-{k}])
+    output_re[..., :-{k}] = (output_re[..., :-{k}] + superdiag_re * input_re[..., {k}:]
+                             - superdiag_im * input_im[..., {k}:])
+    output_im[..., :-{k}] = (output_im[..., :-{k}] + superdiag_re * input_im[..., {k}:]
+                             + superdiag_im * input_re[..., {k}:])
+    return torch.stack((output_re, output_im), dim=-1)
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def butterfly_forward_fn(complex, diagonal):
+    """TorchScript function that multiplies by a butterfly matrix given by its 3
+    nonzero diagonals, specialized to a fixed diagonal offset so that the slice
+    bounds are constants. Compiled once per (complex, diagonal).
+    Parameters:
+        complex: real or complex matrix
+        diagonal: offset of the subdiagonal and superdiagonal
+    Return:
+        fn(diag, subdiag, superdiag, input) if real, with diag: (size, ),
+            subdiag and superdiag: (size - diagonal, ), input: (..., size).
+        fn(diag_re, diag_im, subdiag_re, subdiag_im, superdiag_re, superdiag_im, input)
+            if complex, with the same shapes except input: (..., size, 2).
+    """
+    source = (_FWD_REAL_SOURCE if not complex else _FWD_COMPLEX_SOURCE).format(k=diagonal)
+    return torch.jit.CompilationUnit(source).forward
+
+
+def dia_kernel_supported(input, *diagonals):
+    """Whether the C++ kernel butterfly_dia_mult can be used: CPU tensors that
+    are all float32 or all float64.
+    """
+    return (not input.is_cuda and input.dtype in (torch.float32, torch.float64)
+            and all(diagonal.dtype == input.dtype for diagonal in diagonals))
 
 
 class Butterfly(nn.Module):
@@ -43,45 +118,97 @@ class Butterfly(nn.Module):
             diag: initialization for the diagonal
             subdiag: initialization for the subdiagonal
             superdiag: initialization for the superdiagonal
+                If complex, each initialization is either a (..., 2) tensor or a
+                pair (real, imaginary) of tensors, see below.
         """
         super().__init__()
         assert size > diagonal, 'size must be larger than diagonal'
         self.size = size
         self.diagonal = diagonal
         self.complex = complex
-        self.mul_op = complex_mul if complex else operator.mul
-        diag_shape = (size, 2) if complex else (size, )
-        superdiag_shape = subdiag_shape = (size - diagonal, 2) if complex else (size - diagonal,)
-        if diag is None:
-            self.diag = nn.Parameter(torch.randn(diag_shape))
-            # self.diag = nn.Parameter(torch.ones(diag_shape))
-        else:
-            assert diag.shape == diag_shape, f'diag must have shape {diag_shape}'
-            self.diag = diag
-        if subdiag is None:
-            self.subdiag = nn.Parameter(torch.randn(subdiag_shape))
-            # self.subdiag = nn.Parameter(torch.ones(subdiag_shape))
-        else:
-            assert subdiag.shape == subdiag_shape, f'subdiag must have shape {subdiag_shape}'
-            self.subdiag = subdiag
-        if superdiag is None:
-            self.superdiag = nn.Parameter(torch.randn(superdiag_shape))
-            # self.superdiag = nn.Parameter(torch.ones(superdiag_shape))
+        diag_shape = (size, )
+        superdiag_shape = subdiag_shape = (size - diagonal,)
+        if complex:
+            # Real and imaginary parts are always stored separately (e.g. diag_re
+            # and diag_im) so that the complex multiply only does unit-stride
+            # loads. A (real, imaginary) pair is kept as is, like in the real
+            # case. A (..., 2) tensor is split into its two parts, which are
+            # copied into new Parameters if it is a Parameter.
+            for name, init, shape in (('diag', diag, diag_shape), ('subdiag', subdiag, subdiag_shape),
+                                      ('superdiag', superdiag, superdiag_shape)):
+                if init is None:
+                    re, im = nn.Parameter(torch.randn(shape)), nn.Parameter(torch.randn(shape))
+                elif isinstance(init, (tuple, list)):
+                    re, im = init
+                    assert re.shape == im.shape == shape, f'{name} parts must have shape {shape}'
+                else:
+                    assert init.shape == shape + (2, ), f'{name} must have shape {shape + (2, )}'
+                    re, im = init.unbind(-1)
+                    if isinstance(init, nn.Parameter):
+                        re, im = nn.Parameter(re.detach().clone()), nn.Parameter(im.detach().clone())
+                setattr(self, name + '_re', re)
+                setattr(self, name + '_im', im)
         else:
-            assert superdiag.shape == superdiag_shape, f'superdiag must have shape {superdiag_shape}'
-            self.superdiag = superdiag
+            if diag is None:
+                self.diag = nn.Parameter(torch.randn(diag_shape))
+                # self.diag = nn.Parameter(torch.ones(diag_shape))
+            else:
+                assert diag.shape == diag_shape, f'diag must have shape {diag_shape}'
+                self.diag = diag
+            if subdiag is None:
+                self.subdiag = nn.Parameter(torch.randn(subdiag_shape))
+                # self.subdiag = nn.Parameter(torch.ones(subdiag_shape))
+            else:
+                assert subdiag.shape == subdiag_shape, f'subdiag must have shape {subdiag_shape}'
+                self.subdiag = subdiag
+            if superdiag is None:
+                self.superdiag = nn.Parameter(torch.randn(superdiag_shape))
+                # self.superdiag = nn.Parameter(torch.ones(superdiag_shape))
+            else:
+                assert superdiag.shape == superdiag_shape, f'superdiag must have shape {superdiag_shape}'
+                self.superdiag = superdiag
+
+    @property
+    def forward_fn(self):
+        # Not stored as an attribute since scripted functions can't be pickled
+        return butterfly_forward_fn(self.complex, self.diagonal)
+
+    def complex_parts(self):
+        """Real and imaginary parts of the diagonals of a complex butterfly.
+        Return:
+            (diag_re, diag_im, subdiag_re, subdiag_im, superdiag_re, superdiag_im)
+        """
+        return (self.diag_re, self.diag_im, self.subdiag_re, self.subdiag_im, self.superdiag_re, self.superdiag_im)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints from before the real and imaginary parts were split store
+        # complex diagonals as a single (..., 2) tensor.
+        if self.complex:
+            for name in ('diag', 'subdiag', 'superdiag'):
+                if prefix + name in state_dict:
+                    value = state_dict.pop(prefix + name)
+                    state_dict[prefix + name + '_re'], state_dict[prefix + name + '_im'] = value.unbind(-1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def matrix(self):
         """Matrix form of the butterfly matrix
         """
+        # Write the diagonals directly into one zero matrix instead of summing
+        # three dense diagonal matrices.
         if not self.complex:
-            return (torch.diag(self.diag)
-                    + torch.diag(self.subdiag, -self.diagonal)
-                    + torch.diag(self.superdiag, self.diagonal))
-        else: # Use torch.diag_embed (available in Pytorch 1.0) to deal with complex case.
-            return (torch.diag_embed(self.diag.t(), dim1=0, dim2=1)
-                    + torch.diag_embed(self.subdiag.t(), -self.diagonal, dim1=0, dim2=1)
-                    + torch.diag_embed(self.superdiag.t(), self.diagonal, dim1=0, dim2=1))
+            matrix = torch.zeros(self.size, self.size, dtype=self.diag.dtype, device=self.diag.device)
+            matrix.diagonal().copy_(self.diag)
+            matrix.diagonal(-self.diagonal).copy_(self.subdiag)
+            matrix.diagonal(self.diagonal).copy_(self.superdiag)
+        else:
+            parts = self.complex_parts()
+            matrix = torch.zeros(self.size, self.size, 2, dtype=parts[0].dtype, device=parts[0].device)
+            for i in range(2):  # Real then imaginary part
+                diag, subdiag, superdiag = parts[i::2]
+                matrix[..., i].diagonal().copy_(diag)
+                matrix[..., i].diagonal(-self.diagonal).copy_(subdiag)
+                matrix[..., i].diagonal(self.diagonal).copy_(superdiag)
+        return matrix
 
     def forward(self, input):
         """
@@ -90,18 +217,75 @@ class Butterfly(nn.Module):
         Return:
             output: (..., size) if real or (..., size, 2) if complex
         """
+        # The scripted forward handles CUDA and the dtypes the C++ kernel doesn't
         if not self.complex:
-            output = self.diag * input
-            output[..., self.diagonal:] += self.subdiag * input[..., :-self.diagonal]
-            output[..., :-self.diagonal] += self.superdiag * input[..., self.diagonal:]
+            if not dia_kernel_supported(input, self.diag, self.subdiag, self.superdiag):
+                output = self.forward_fn(self.diag, self.subdiag, self.superdiag, input)
+            else:  # Single pass over the input with the C++ kernel
+                output = butterfly_dia_mult(self.diag, self.subdiag, self.superdiag,
+                                            input.reshape(-1, self.size), self.diagonal).view(input.shape)
         else:
-            output = self.mul_op(self.diag, input)
-            output[..., self.diagonal:, :] += self.mul_op(self.subdiag, input[..., :-self.diagonal, :])
-            output[..., :-self.diagonal, :] += self.mul_op(self.superdiag, input[..., self.diagonal:, :])
+            diagonals = self.complex_parts()
+            if not dia_kernel_supported(input, *diagonals):
+                output = self.forward_fn(*diagonals, input)
+            else:
+                output = butterfly_dia_mult_complex(*diagonals, input.reshape(-1, self.size, 2),
+                                                    self.diagonal).view(input.shape)
         # assert torch.allclose(output, input @ self.matrix().t())
         return output
 
 
+def chain_matmul_optimal(matrices, matmul_op=operator.matmul):
+    """Multiply a chain of matrices, choosing the parenthesization that
+    minimizes the number of scalar multiplications (the standard O(k^3)
+    dynamic program). Works for any matmul_op, e.g. complex_matmul.
+    Parameters:
+        matrices: list of k matrices of shape (n_i, n_{i+1}) if real or (n_i, n_{i+1}, 2) if complex
+        matmul_op: function to multiply two matrices
+    Return:
+        product: (n_0, n_k) if real or (n_0, n_k, 2) if complex
+    """
+    k = len(matrices)
+    dims = [matrix.shape[0] for matrix in matrices] + [matrices[-1].shape[1]]
+    cost = [[0] * k for _ in range(k)]
+    split = [[0] * k for _ in range(k)]
+    for length in range(1, k):
+        for i in range(k - length):
+            j = i + length
+            cost[i][j] = math.inf
+            for s in range(i, j):
+                c = cost[i][s] + cost[s + 1][j] + dims[i] * dims[s + 1] * dims[j + 1]
+                if c < cost[i][j]:
+                    cost[i][j], split[i][j] = c, s
+
+    def multiply(i, j):
+        if i == j:
+            return matrices[i]
+        return matmul_op(multiply(i, split[i][j]), multiply(split[i][j] + 1, j))
+
+    return multiply(0, k - 1)
+
+
+@torch.jit.script
+def butterfly_mixture_mult(prob, diag, offdiag, index, input):
+    """Multiply by a weighted sum of k butterfly matrices in one pass, instead of
+    multiplying by each butterfly matrix and then taking the weighted sum.
+    Parameters:
+        prob: (k, ), weights of the butterfly matrices
+        diag: (k, size), diagonals
+        offdiag: (2 k, size), subdiagonals then superdiagonals, zero-padded so
+            that offdiag[j, i] is the coefficient of input[..., index[j, i]] in output[..., i]
+        index: (2 k, size), column of each entry of offdiag
+        input: (..., size)
+    Return:
+        output: (..., size)
+    """
+    output = (prob.unsqueeze(-1) * diag).sum(dim=0) * input
+    weight = torch.cat((prob, prob)).unsqueeze(-1) * offdiag
+    gathered = input.index_select(-1, index.reshape(-1)).view(input.size()[:-1] + index.size())
+    return output + (weight * gathered).sum(dim=-2)
+
+
 class MatrixProduct(nn.Module):
     """Product of matrices. The order are chosen by softmaxes, which are learnable.
     Each factor matrix must implement .matrix() function.
@@ -114,28 +298,43 @@ class MatrixProduct(nn.Module):
             n_terms = len(factors)
         self.n_terms = n_terms
         self.complex = complex
-        self.matmul_op = complex_matmul if complex else operator.matmul
+        self.matmul_op = complex_matmul_native if complex else operator.matmul
         self.fixed_order = fixed_order
         if not self.fixed_order:
             assert softmax_fn in ['softmax', 'sparsemax']
             self.logit = nn.Parameter(torch.randn((self.n_terms, len(factors))))
-            if softmax_fn == 'softmax':
-                self.softmax_fn = lambda logit: nn.functional.softmax(logit, dim=-1)
-            else:
-                self.softmax_fn = sparsemax
+            self.softmax_mode = softmax_fn
+
+    def softmax_fn(self, logit):
+        """Softmax or sparsemax over the last dimension, depending on softmax_mode.
+        A method rather than a lambda attribute so that the module can be
+        pickled and scripted.
+        """
+        if self.softmax_mode == 'softmax':
+            return nn.functional.softmax(logit, dim=-1)
+        else:
+            return sparsemax(logit)
+
+    def multi_matmul(self, matrices):
+        """Product of a list of matrices, multiplied in the cheapest order.
+        """
+        if len(matrices) == 1:
+            return matrices[0]
+        if not self.complex:
+            return torch.linalg.multi_dot(list(matrices))
+        else:  # torch.linalg.multi_dot doesn't work for our complex format
+            return chain_matmul_optimal(list(matrices), self.matmul_op)
 
     def matrix(self, temperature=1.0):
         if self.fixed_order:
             matrices = [factor.matrix() for factor in self.factors]
-            return functools.reduce(self.matmul_op, matrices)
+            return self.multi_matmul(matrices)
         else:
             prob = self.softmax_fn(self.logit / temperature)
             stack = torch.stack([factor.matrix() for factor in self.factors])
-            matrices = (prob @ stack.reshape(stack.shape[0], -1)).reshape((-1,) + stack.shape[1:])
-            # Alternative: slightly slower but easier to understand
-            # matrices = torch.einsum('ab, b...->a...', (prob, stack))
-            # return torch.chain_matmul(*matrices)  ## Doesn't work for complex
-            return functools.reduce(self.matmul_op, matrices)
+            matrices = torch.einsum('ab,b...->a...', prob, stack)
+            # matrices = (prob @ stack.reshape(stack.shape[0], -1)).reshape((-1,) + stack.shape[1:])
+            return self.multi_matmul(matrices.unbind(0))
 
     def forward(self, input, temperature=1.0):
         """
@@ -155,7 +354,8 @@ class MatrixProduct(nn.Module):
             for i in range(self.n_terms)[::-1]:
                 # output = (torch.stack([factor(output) for factor in self.factors], dim=-1) * prob[i]).sum(dim=-1)
                 stack = torch.stack([factor(output) for factor in self.factors])
-                output = (prob[i:i+1] @ stack.reshape(stack.shape[0], -1)).reshape(stack.shape[1:])
+                # Broadcast multiply + reduce instead of a gemv over the tiny factor dimension
+                output = (stack * prob[i].view((-1, ) + (1, ) * (stack.dim() - 1))).sum(dim=0)
             return output
 
 
@@ -168,20 +368,77 @@ class ButterflyProduct(MatrixProduct):
         m = int(math.log2(size))
         assert size == 1 << m, "size must be a power of 2"
         self.size = size
-        factors = [Butterfly(size, diagonal=1 << i, complex=complex) for i in range(m)[::-1]]
+        diagonals = [1 << i for i in range(m)[::-1]]
+        # Draw the initial diagonals of all the factors at once and split them up.
+        # Each one is cloned so that the parameters don't share storage (and
+        # version counter), otherwise an in-place update to one of them would
+        # invalidate the autograd graph of all the others.
+        lengths = [length for diagonal in diagonals for length in (size, size - diagonal, size - diagonal)]
+        if not complex:
+            inits = [nn.Parameter(init.clone()) for init in torch.randn(sum(lengths)).split(lengths)]
+        else:  # (real, imaginary) pairs, see Butterfly
+            inits = [tuple(nn.Parameter(part.clone()) for part in init)
+                     for init in torch.randn(2, sum(lengths)).split(lengths, dim=-1)]
+        factors = [Butterfly(size, diagonal=diagonal, complex=complex,
+                             diag=inits[3 * i], subdiag=inits[3 * i + 1], superdiag=inits[3 * i + 2])
+                   for i, diagonal in enumerate(diagonals)]
         super().__init__(factors, n_terms, complex, fixed_order, softmax_fn)
         self.learn_perm = learn_perm
         if learn_perm:
             self.perm_logit = nn.Parameter(torch.randn((size, size)))
+        if not fixed_order and not complex:
+            # Column of each entry of the zero-padded subdiagonals and superdiagonals
+            # in stacked_diagonals(). Out of range columns are clamped, their
+            # coefficients are zero.
+            offsets = torch.tensor([factor.diagonal for factor in self.factors]).unsqueeze(-1)
+            positions = torch.arange(size)
+            self.register_buffer('offdiag_index', torch.cat(((positions - offsets).clamp(min=0),
+                                                             (positions + offsets).clamp(max=size - 1))),
+                                 persistent=False)
+        # Cache of matrix() for evaluation, see matrix_cache_key()
+        self._cached_matrix = None
+        self._cached_key = None
+
+    def matrix_cache_key(self, temperature):
+        """Key identifying the output of matrix(). It changes whenever a
+        parameter is modified in place (version counter) or moved (data_ptr).
+        """
+        return (temperature, tuple((p.data_ptr(), p._version) for p in self.parameters()))
+
+    def train(self, mode=True):
+        self._cached_matrix = self._cached_key = None
+        return super().train(mode)
+
+    def stacked_diagonals(self):
+        """Diagonals of all the factors, stacked for butterfly_mixture_mult.
+        Return:
+            diag: (k, size)
+            offdiag: (2 k, size), subdiagonals then superdiagonals, zero-padded to size
+        """
+        diag = torch.stack([factor.diag for factor in self.factors])
+        offdiag = torch.stack([F.pad(factor.subdiag, (factor.diagonal, 0)) for factor in self.factors]
+                              + [F.pad(factor.superdiag, (0, factor.diagonal)) for factor in self.factors])
+        return diag, offdiag
 
     def matrix(self, temperature=1.0):
+        # In eval mode without autograd, the parameters don't change between
+        # calls, so we can reuse the previous result. Return a copy so that
+        # callers modifying the result don't corrupt the cache.
+        use_cache = not self.training and not torch.is_grad_enabled()
+        if use_cache:
+            key = self.matrix_cache_key(temperature)
+            if key == self._cached_key:
+                return self._cached_matrix.clone()
         matrix = super().matrix(temperature)
         if self.learn_perm:
-            perm = sinkhorn(self.perm_logit / temperature)
+            perm = sinkhorn(self.perm_logit / temperature, tol=None if self.training else SINKHORN_EVAL_TOL)
             if not self.complex:
                 matrix = matrix @ perm
             else:
-                matrix = (matrix.transpose(-1, -2) @ perm).transpose(-1, -2)
+                matrix = torch.einsum('ajc,jb->abc', matrix, perm)
+        if use_cache:
+            self._cached_matrix, self._cached_key = matrix, key
+            return matrix.clone()
         return matrix
 
     def forward(self, input, temperature=1.0):
@@ -192,12 +449,22 @@ class ButterflyProduct(MatrixProduct):
             output: (..., size) if real or (..., size, 2) if complex
         """
         if self.learn_perm:
-            perm = sinkhorn(self.perm_logit / temperature)
+            perm = sinkhorn(self.perm_logit / temperature, tol=None if self.training else SINKHORN_EVAL_TOL)
             if not self.complex:
                 input = input @ perm.t()
             else:
-                input = (input.transpose(-1, -2) @ perm.t()).transpose(-1, -2)
-        return super().forward(input, temperature)
+                input = torch.einsum('kj,...jc->...kc', perm, input)
+        if self.fixed_order or self.complex or input.numel() > MIXTURE_MAX_NUMEL:
+            return super().forward(input, temperature)
+        # Each term is a mixture of the factors, which is again banded, so for
+        # small inputs it is faster to apply it in one pass than to call the
+        # factors one by one.
+        diag, offdiag = self.stacked_diagonals()
+        prob = self.softmax_fn(self.logit / temperature)
+        output = input
+        for i in range(self.n_terms)[::-1]:
+            output = butterfly_mixture_mult(prob[i], diag, offdiag, self.offdiag_index, output)
+        return output
 
 
 class Block2x2Diag(nn.Module):
@@ -654,6 +921,16 @@ class FixedPermutation(nn.Module):
 
 
 
+def test_sinkhorn():
+    logit = torch.randn(3, 8, 8, requires_grad=True)
+    perm = sinkhorn(logit)
+    assert torch.allclose(perm.sum(dim=-2), torch.ones(3, 8), atol=1e-6)
+    with torch.no_grad():
+        assert torch.allclose(sinkhorn(logit), perm)
+        perm_early = sinkhorn(logit, n_iters=100, tol=1e-4)
+        assert torch.allclose(perm_early.sum(dim=-1), torch.ones(3, 8), atol=1e-3)
+
+
 def test_butterfly():
     size = 4
     diag = torch.tensor([[1, 2], [2, 3], [3, 4], [4, 5]], dtype=torch.float)
@@ -672,11 +949,41 @@ def test_butterfly():
 
     batch_size = 3
     x = torch.randn((batch_size, size, 2))
-    prod = torch.stack((x[..., 0] @ matrix_real.t() - x[..., 1] @ matrix_imag.t(),
-                        x[..., 0] @ matrix_imag.t() + x[..., 1] @ matrix_real.t()), dim=-1)
+    matrix = torch.complex(matrix_real, matrix_imag)
+    prod = torch.view_as_real(torch.view_as_complex(x) @ matrix.t())
+    assert torch.allclose(model.forward(x), prod)
     assert torch.allclose(model.forward(x), complex_matmul(x, model.matrix().transpose(0, 1)))
 
 
+def test_butterfly_complex_parameters():
+    size = 8
+    names = ['diag_im', 'diag_re', 'subdiag_im', 'subdiag_re', 'superdiag_im', 'superdiag_re']
+    diag = (nn.Parameter(torch.randn(size)), nn.Parameter(torch.randn(size)))
+    model = Butterfly(size, diagonal=2, complex=True, diag=diag)
+    assert model.diag_re is diag[0]  # Shared with the caller, like in the real case
+    assert sorted(name for name, _ in model.named_parameters()) == names
+    model = Butterfly(size, diagonal=2, complex=True, diag=nn.Parameter(torch.randn(size, 2)))
+    assert sorted(name for name, _ in model.named_parameters()) == names
+    # Same layout as the factors of ButterflyProduct
+    product = ButterflyProduct(size, complex=True)
+    product.factors[1].load_state_dict(model.state_dict())
+    assert torch.equal(product.factors[1].diag_re, model.diag_re)
+    # Old checkpoints store each complex diagonal as one (..., 2) tensor
+    model = Butterfly(size, diagonal=2, complex=True)
+    state_dict = {name: torch.randn(shape) for name, shape in
+                  [('diag', (size, 2)), ('subdiag', (size - 2, 2)), ('superdiag', (size - 2, 2))]}
+    model.load_state_dict(state_dict)
+    assert torch.equal(model.subdiag_im, state_dict['subdiag'][:, 1])
+
+
+def test_chain_matmul_optimal():
+    matrices = [torch.randn(5, 30), torch.randn(30, 2), torch.randn(2, 40), torch.randn(40, 3)]
+    assert torch.allclose(chain_matmul_optimal(matrices), matrices[0] @ matrices[1] @ matrices[2] @ matrices[3], atol=1e-4)
+    matrices = [torch.randn(5, 30, 2), torch.randn(30, 2, 2), torch.randn(2, 40, 2)]
+    assert torch.allclose(chain_matmul_optimal(matrices, complex_matmul),
+                          complex_matmul(complex_matmul(matrices[0], matrices[1]), matrices[2]), atol=1e-4)
+
+
 def test_butterfly_product():
     size = 4
     model = ButterflyProduct(size, complex=True)
@@ -689,6 +996,42 @@ def test_butterfly_product():
     assert torch.allclose(model.forward(x), complex_matmul(x, model.matrix().transpose(0, 1)))
 
 
+def test_butterfly_mixture_mult():
+    model = ButterflyProduct(16, n_terms=3)
+    x = torch.randn(5, 16)
+    # Same as multiplying by the factors one by one and mixing the outputs
+    assert torch.allclose(model(x, temperature=0.5), MatrixProduct.forward(model, x, temperature=0.5), atol=1e-5)
+
+
+def test_butterfly_product_independent_parameters():
+    for complex in [False, True]:
+        model = ButterflyProduct(8, complex=complex)
+        output = model.factors[0](torch.randn((3, 8, 2) if complex else (3, 8)))
+        # Modifying one factor in place must not affect the others
+        with torch.no_grad():
+            for p in model.factors[2].parameters():
+                p.clamp_(-10, 10)
+        assert all(p._version == 0 for p in model.factors[0].parameters())
+        output.sum().backward()
+        assert all(p.grad is not None for p in model.factors[0].parameters())
+
+
+def test_butterfly_product_matrix_cache():
+    model = ButterflyProduct(8, learn_perm=True)
+    model.eval()
+    with torch.no_grad():
+        matrix = model.matrix()
+        cached = model._cached_matrix
+        assert model.matrix(temperature=1.0).data_ptr() != matrix.data_ptr()
+        assert model._cached_matrix is cached
+        matrix_copy = matrix.clone()
+        matrix.zero_()  # Must not change the cached matrix
+        assert torch.equal(model.matrix(), matrix_copy)
+        model.factors[0].diag.mul_(2.0)
+        assert not torch.allclose(model.matrix(), matrix_copy)
+        assert not torch.allclose(model.matrix(temperature=0.5), model.matrix())
+
+
 def test_butterfly_fft():
     # DFT matrix for n = 4
     size = 4
@@ -778,8 +1121,14 @@ def test_blockpermproduct():
 
 
 def main():
+    test_sinkhorn()
     test_butterfly()
+    test_butterfly_complex_parameters()
+    test_chain_matmul_optimal()
     test_butterfly_product()
+    test_butterfly_mixture_mult()
+    test_butterfly_product_independent_parameters()
+    test_butterfly_product_matrix_cache()
 
 
 if __name__ == '__main__':
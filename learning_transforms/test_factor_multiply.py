@@ -2,9 +2,9 @@ import unittest
 
 import torch
 
-from butterfly_factor import butterfly_factor_mult, butterfly_factor_mult_intermediate
-from butterfly import Block2x2DiagProduct
-from complex_utils import complex_mul
+from butterfly_factor import butterfly_factor_mult, butterfly_factor_mult_intermediate, butterfly_dia_mult, butterfly_dia_mult_complex
+from butterfly_old import Block2x2DiagProduct, Butterfly
+from butterfly.complex_utils import complex_mul
 
 from factor_multiply import butterfly_multiply_intermediate, butterfly_multiply_intermediate_backward
 
@@ -77,6 +77,48 @@ class ButterflyFactorTest(unittest.TestCase):
             self.assertTrue(torch.allclose(d_twiddle, d_twiddle_slow, rtol=self.rtol, atol=self.atol), (factor.size, (d_twiddle - d_twiddle_slow).abs().max().item()))
             self.assertTrue(torch.allclose(d_input, d_input_slow, rtol=self.rtol, atol=self.atol), (d_input - d_input_slow).abs().max().item())
 
+    def test_butterfly_dia_cpu(self):
+        batch_size = 10
+        n = 4096
+        for diagonal in [1, 2, n // 2]:
+            B = Butterfly(n, diagonal=diagonal)
+            input_ = torch.randn(batch_size, n, requires_grad=True)
+            output = butterfly_dia_mult(B.diag, B.subdiag, B.superdiag, input_, diagonal)
+            output_slow = input_ @ B.matrix().t()
+            self.assertTrue(torch.allclose(output, output_slow, rtol=self.rtol, atol=self.atol), (output - output_slow).abs().max().item())
+            grad = torch.randn_like(output)
+            d = torch.autograd.grad(output, (B.diag, B.subdiag, B.superdiag, input_), grad, retain_graph=True)
+            d_slow = torch.autograd.grad(output_slow, (B.diag, B.subdiag, B.superdiag, input_), grad, retain_graph=True)
+            for d_, d_slow_ in zip(d, d_slow):
+                self.assertTrue(torch.allclose(d_, d_slow_, rtol=self.rtol, atol=self.atol), (d_ - d_slow_).abs().max().item())
+
+    def test_butterfly_dia_complex_cpu(self):
+        batch_size = 10
+        n = 4096
+        for diagonal in [1, 2, n // 2]:
+            B = Butterfly(n, diagonal=diagonal, complex=True)
+            diagonals = (B.diag_re, B.diag_im, B.subdiag_re, B.subdiag_im, B.superdiag_re, B.superdiag_im)
+            input_ = torch.randn(batch_size, n, 2, requires_grad=True)
+            output = butterfly_dia_mult_complex(*diagonals, input_, diagonal)
+            output_slow = (complex_mul(B.matrix(), input_.unsqueeze(1))).sum(dim=-2)
+            self.assertTrue(torch.allclose(output, output_slow, rtol=self.rtol, atol=self.atol), (output - output_slow).abs().max().item())
+            grad = torch.randn_like(output)
+            d = torch.autograd.grad(output, diagonals + (input_, ), grad, retain_graph=True)
+            d_slow = torch.autograd.grad(output_slow, diagonals + (input_, ), grad, retain_graph=True)
+            for d_, d_slow_ in zip(d, d_slow):
+                self.assertTrue(torch.allclose(d_, d_slow_, rtol=self.rtol, atol=self.atol), (d_ - d_slow_).abs().max().item())
+
+    def test_butterfly_dia_bad_arguments_cpu(self):
+        n, diagonal = 8, 2
+        diag, subdiag, superdiag = torch.randn(n), torch.randn(n - diagonal), torch.randn(n - diagonal)
+        input_ = torch.randn(3, n)
+        with self.assertRaises(RuntimeError):  # Wrong size of diag
+            butterfly_dia_mult(diag[1:], subdiag, superdiag, input_, diagonal)
+        with self.assertRaises(RuntimeError):  # Wrong size of superdiag
+            butterfly_dia_mult(diag, subdiag, superdiag[1:], input_, diagonal)
+        with self.assertRaises(RuntimeError):  # Mixed dtypes
+            butterfly_dia_mult(diag, subdiag, superdiag, input_.double(), diagonal)
+
     def test_butterfly_factor_intermediate_cpu(self):
         batch_size = 10
         n = 4096
@@ -95,42 +95,34 @@ class ButterflySpecialTest(unittest.TestCase):
         for complex in [False, True]:
             dtype = torch.float32 if not complex else torch.complex64
             col = torch.randn(n, dtype=dtype)
-            C = la.circulant(col.numpy())
+            row = torch.randn(n, dtype=dtype)
             input = torch.randn(batch_size, n, dtype=dtype)
-            out_torch = torch.tensor(input.detach().numpy() @ C.T)
-            out_np = torch.tensor(np.fft.ifft(np.fft.fft(input.numpy()) * np.fft.fft(col.numpy())),
-                                  dtype=dtype)
-            self.assertTrue(torch.allclose(out_torch, out_np, self.rtol, self.atol))
+            input_f = np.fft.fft(input.numpy())
+            # FFT of col and row in a single call
+            filters_f = np.fft.fft(np.stack((col.numpy(), row.numpy())))
+            # row is the reverse of col, except the 0-th element stays put
+            # This corresponds to the same reversal in the frequency domain.
+            # https://en.wikipedia.org/wiki/Discrete_Fourier_transform#Time_and_frequency_reversal
+            filters_f[1, 1:] = filters_f[1, :0:-1].copy()
+            out_np = torch.tensor(np.fft.ifft(input_f * filters_f[:, None]), dtype=dtype)
+            C_col = la.circulant(col.numpy())
+            C_row = la.circulant(row.numpy()).T
             # Just to show how to implement circulant multiply with FFT
             if complex:
                 input_f = torch.fft.fft(input)
                 col_f = torch.fft.fft(col)
                 prod_f = input_f * col_f
                 out_fft = torch.fft.ifft(prod_f)
+                out_torch = torch.tensor(input.numpy() @ C_col.T)
                 self.assertTrue(torch.allclose(out_torch, out_fft, self.rtol, self.atol))
-            for separate_diagonal in [True, False]:
-                b = torch_butterfly.special.circulant(col, transposed=False,
-                                                      separate_diagonal=separate_diagonal)
-                out = b(input)
-                self.assertTrue(torch.allclose(out, out_torch, self.rtol, self.atol))
-
-            row = torch.randn(n, dtype=dtype)
-            C = la.circulant(row.numpy()).T
-            input = torch.randn(batch_size, n, dtype=dtype)
-            out_torch = torch.tensor(input.detach().numpy() @ C.T)
-            # row is the reverse of col, except the 0-th element stays put
-            # This corresponds to the same reversal in the frequency domain.
-            # https://en.wikipedia.org/wiki/Discrete_Fourier_transform#Time_and_frequency_reversal
-            row_f = np.fft.fft(row.numpy())
-            row_f_reversed = np.hstack((row_f[:1], row_f[1:][::-1]))
-            out_np = torch.tensor(np.fft.ifft(np.fft.fft(input.numpy())
-                                              * row_f_reversed), dtype=dtype)
-            self.assertTrue(torch.allclose(out_torch, out_np, self.rtol, self.atol))
-            for separate_diagonal in [True, False]:
-                b = torch_butterfly.special.circulant(row, transposed=True,
-                                                      separate_diagonal=separate_diagonal)
-                out = b(input)
-                self.assertTrue(torch.allclose(out, out_torch, self.rtol, self.atol))
+            for i, (v, C, transposed) in enumerate([(col, C_col, False), (row, C_row, True)]):
+                out_torch = torch.tensor(input.numpy() @ C.T)
+                self.assertTrue(torch.allclose(out_torch, out_np[i], self.rtol, self.atol))
+                for separate_diagonal in [True, False]:
+                    b = torch_butterfly.special.circulant(v, transposed=transposed,
+                                                          separate_diagonal=separate_diagonal)
+                    out = b(input)
+                    self.assertTrue(torch.allclose(out, out_torch, self.rtol, self.atol))
 
     def test_toeplitz(self):
         batch_size = 10